@@ -0,0 +1,537 @@
+"""
+Benchmarks and load tests for ai_chat_system, with an offline mock provider
+and fake Telegram objects. Run through the main module:
+
+    python ai_chat_system.py --benchmark NAME [--param KEY=VALUE ...]
+"""
+
+import os
+import sys
+import json
+import asyncio
+import argparse
+import subprocess
+import tempfile
+import time
+import random
+from pathlib import Path
+from types import SimpleNamespace
+from datetime import datetime
+from typing import Dict, List, Any
+from collections import defaultdict
+
+import ai_chat_system
+from ai_chat_system import (
+    AIManager, ChatDispatcher, DeliveryQueue, ExampleIndex, Histogram, LatencyWindow,
+    PersonalityCloner, ProviderBackend, RateLimiter, TelegramBot, collect_metrics,
+    estimate_tokens, logger
+)
+
+# ============= MOCK PROVIDER =============
+class MockRateLimitError(RuntimeError):
+    """The 429 a MockProvider returns when its server-side limit is exceeded"""
+    status_code = 429
+    
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name}: 429 rate limit exceeded")
+        self.response = SimpleNamespace(headers={'retry-after': f"{retry_after:.3f}"})
+
+class MockProvider(ProviderBackend):
+    """Offline provider for load tests without API keys
+    
+    Latency is log-normal around latency (jitter is the log-space sigma; 0
+    gives a fixed delay), error_rate of calls fail, and streams yield the
+    reply word by word at tokens_per_s after the first-token latency.
+    server_limit plays the provider's own rate limit: calls over it get a 429.
+    """
+    def __init__(self, latency: float = 0.05, reply: str = "mock reply", jitter: float = 0.0,
+                 error_rate: float = 0.0, tokens_per_s: float = None, name: str = "mock",
+                 seed: int = None, server_limit: RateLimiter = None, **kwargs):
+        super().__init__(**kwargs)
+        self.server_limit = server_limit
+        self.name = name
+        self.latency = latency
+        self.reply = reply
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tokens_per_s = tokens_per_s
+        self.rng = random.Random(seed)
+    
+    async def _delay(self):
+        if self.server_limit is not None:
+            retry_after = self.server_limit.try_acquire()
+            if retry_after:
+                raise MockRateLimitError(self.name, retry_after)
+        delay = self.latency
+        if self.jitter:
+            delay *= self.rng.lognormvariate(0.0, self.jitter)
+        await asyncio.sleep(delay)
+        if self.error_rate and self.rng.random() < self.error_rate:
+            raise RuntimeError(f"{self.name}: simulated provider error")
+    
+    async def _complete(self, messages: List[Dict], max_tokens: int, system: str) -> str:
+        await self._delay()
+        self.record_usage(estimate_tokens(messages[-1]['content']), estimate_tokens(self.reply))
+        return self.reply
+    
+    async def _stream(self, messages: List[Dict], max_tokens: int, system: str):
+        if not self.tokens_per_s:
+            yield await self._complete(messages, max_tokens, system)
+            return
+        
+        await self._delay()
+        words = self.reply.split(' ')
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(1 / self.tokens_per_s)
+            yield word if i == 0 else ' ' + word
+        self.record_usage(estimate_tokens(messages[-1]['content']), estimate_tokens(self.reply))
+
+# ============= BENCHMARKS =============
+def benchmark_ingestion(size_mb: int = 50) -> Dict[str, Any]:
+    """Throughput of streaming WhatsApp and Telegram export ingestion in MB/s"""
+    import psutil
+    
+    process = psutil.Process()
+    senders = ['Alex', 'Sam', 'Jordan']
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        txt = Path(tmp) / 'chat.txt'
+        with open(txt, 'w', encoding='utf-8') as f:
+            written = 0
+            i = 0
+            while written < size_mb * 1024 * 1024:
+                line = (f"{i % 12 + 1}/{i % 28 + 1}/23, {i % 12 + 1}:{i % 60:02d} PM - "
+                        f"{senders[i % 3]}: message number {i} with some text 😀\n")
+                if i % 7 == 0:
+                    line += "and a second line\n"
+                f.write(line)
+                written += len(line.encode())
+                i += 1
+        
+        js = Path(tmp) / 'result.json'
+        with open(js, 'w', encoding='utf-8') as f:
+            f.write('{"name": "bench", "messages": [')
+            written = 0
+            i = 0
+            while written < size_mb * 1024 * 1024:
+                record = json.dumps({"id": i, "type": "message", "date": "2023-05-01T12:00:00",
+                                     "from": senders[i % 3],
+                                     "text": f"message number {i} with some text 😀"})
+                f.write((',' if i else '') + record)
+                written += len(record)
+                i += 1
+            f.write(']}')
+        
+        for fmt, path in (('whatsapp', txt), ('telegram', js)):
+            cloner = PersonalityCloner('Alex')
+            rss_before = process.memory_info().rss
+            started = time.perf_counter()
+            cloner.learn_from_file(path)
+            elapsed = time.perf_counter() - started
+            rss_growth = process.memory_info().rss - rss_before
+            
+            megabytes = path.stat().st_size / (1024 * 1024)
+            results[fmt] = {
+                "megabytes": round(megabytes, 1),
+                "seconds": round(elapsed, 2),
+                "mb_per_s": round(megabytes / elapsed, 1),
+                "messages": cloner.stats['messages'],
+                "rss_growth_mb": round(rss_growth / (1024 * 1024), 1)
+            }
+    return results
+
+def benchmark_example_index(pairs: int = 100000, queries: int = 1000) -> Dict[str, Any]:
+    """Build time and lookup latency of ExampleIndex on a synthetic profile"""
+    rng = random.Random(42)
+    # Zipf-ish vocabulary so common words have long posting lists, like real chats
+    words = [f"w{i}" for i in range(20000)]
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    
+    def sentence(length: int) -> str:
+        return ' '.join(rng.choices(words, weights, k=length))
+    
+    data = [(sentence(rng.randint(3, 15)), sentence(rng.randint(2, 10))) for _ in range(pairs)]
+    started = time.perf_counter()
+    index = ExampleIndex.build(data)
+    build_seconds = time.perf_counter() - started
+    
+    latency = LatencyWindow(size=queries)
+    for _ in range(queries):
+        query = sentence(rng.randint(3, 12))
+        started = time.perf_counter()
+        index.select(query, k=5, budget=800)
+        latency.add(time.perf_counter() - started)
+    
+    return {"pairs": len(index), "vocabulary": len(index.vocab),
+            "build_seconds": round(build_seconds, 2), "lookup": latency.snapshot()}
+
+def benchmark_startup(runs: int = 5, budget: float = 1.0) -> Dict[str, Any]:
+    """Cold import time of ai_chat_system in fresh interpreters, against a budget in seconds"""
+    module_dir = str(Path(ai_chat_system.__file__).resolve().parent)
+    module = Path(ai_chat_system.__file__).stem
+    code = (f"import sys, time; sys.path.insert(0, {module_dir!r}); t = time.perf_counter(); "
+            f"import {module}; print(time.perf_counter() - t)")
+    
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                                text=True, check=True).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    
+    # Modules that a Telegram-only setup should not pay for at startup
+    heavy = ['selenium', 'discord', 'anthropic', 'google.generativeai', 'telegram', 'numpy']
+    check = (f"import sys; sys.path.insert(0, {module_dir!r}); import {module}; "
+             f"print(','.join(m for m in {heavy!r} if m in sys.modules))")
+    eager = subprocess.run([sys.executable, '-c', check], capture_output=True,
+                           text=True, check=True).stdout.strip()
+    
+    timings.sort()
+    median = timings[len(timings) // 2]
+    return {"runs": runs, "median_s": round(median, 3), "max_s": round(timings[-1], 3),
+            "budget_s": budget, "within_budget": median <= budget,
+            "eager_imports": eager.split(',') if eager else []}
+
+async def load_test(base_url: str, requests: int, concurrency: int,
+                    ready_timeout: float = 30.0) -> Dict[str, Any]:
+    """Throughput and latency of POST /api/test against a running server"""
+    import aiohttp
+    
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        deadline = time.monotonic() + ready_timeout
+        while True:
+            try:
+                async with session.get(f"{base_url}/api/stats") as response:
+                    if response.status == 200:
+                        break
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"server at {base_url} did not come up")
+            await asyncio.sleep(0.2)
+        
+        latency = LatencyWindow(size=requests)
+        errors = 0
+        
+        async def worker(count: int):
+            nonlocal errors
+            for _ in range(count):
+                started = time.perf_counter()
+                try:
+                    async with session.post(f"{base_url}/api/test",
+                                            json={"message": "hello"}) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                except aiohttp.ClientError:
+                    errors += 1
+                latency.add(time.perf_counter() - started)
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(requests // concurrency + (i < requests % concurrency))
+                               for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    
+    return {"requests": requests, "errors": errors, "seconds": round(elapsed, 2),
+            "requests_per_s": round(requests / elapsed, 1), "latency": latency.snapshot()}
+
+def benchmark_server(requests: int = 3000, concurrency: int = 64,
+                     latency: float = 0.05) -> Dict[str, Any]:
+    """/api/test load test of the Flask and aiohttp server modes, each in its own process"""
+    import socket
+    
+    results = {"concurrency": concurrency, "mock_latency_s": latency}
+    for mode in ('flask', 'aiohttp'):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        
+        server = subprocess.Popen([sys.executable, str(Path(ai_chat_system.__file__).resolve()),
+                                   '--server', mode, '--host', '127.0.0.1', '--port', str(port),
+                                   '--mock-latency', str(latency)],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            results[mode] = asyncio.run(load_test(f"http://127.0.0.1:{port}", requests, concurrency))
+        finally:
+            server.terminate()
+            server.wait()
+    return results
+
+class FakeTelegramChat:
+    """A simulated Telegram chat that records when its messages get answered"""
+    def __init__(self, chat_id: int, latency: LatencyWindow):
+        self.id = chat_id
+        self.latency = latency
+        self.waiting = []  # perf_counter() of each message not yet answered
+        self.replies = 0
+    
+    def answered(self):
+        """The bot finished a reply: every message it covered is done"""
+        now = time.perf_counter()
+        for sent_at in self.waiting:
+            self.latency.add(now - sent_at)
+        self.waiting = []
+        self.replies += 1
+
+class FakeTelegramMessage:
+    """Just enough of telegram.Message for TelegramBot's handlers"""
+    def __init__(self, chat: FakeTelegramChat, text: str, message_id: int,
+                 network_latency: float = 0.0):
+        self.chat = chat
+        self.text = text
+        self.message_id = message_id
+        self.network_latency = network_latency
+    
+    async def reply_text(self, text: str):
+        await asyncio.sleep(self.network_latency)
+        return FakeTelegramMessage(self.chat, text, -self.message_id, self.network_latency)
+    
+    async def edit_text(self, text: str):
+        await asyncio.sleep(self.network_latency)
+
+class FakeTelegramUpdate:
+    """Just enough of telegram.Update for TelegramBot.handle_message"""
+    def __init__(self, chat: FakeTelegramChat, user_id: int, text: str, message_id: int,
+                 network_latency: float = 0.0):
+        self.effective_chat = chat
+        self.effective_user = argparse.Namespace(id=user_id, first_name=f"user{user_id}")
+        self.message = FakeTelegramMessage(chat, text, message_id, network_latency)
+
+async def simulate_telegram(bot: TelegramBot, chats: int, messages_per_chat: int, rate: float,
+                            seed: int = 42, network_latency: float = 0.02,
+                            drain_timeout: float = 120.0) -> Dict[str, Any]:
+    """Feed fake updates into a TelegramBot at rate msgs/s (Poisson) and time the replies"""
+    rng = random.Random(seed)
+    latency = LatencyWindow(size=chats * messages_per_chat)
+    fake_chats = [FakeTelegramChat(1000 + i, latency) for i in range(chats)]
+    order = [chat for chat in fake_chats for _ in range(messages_per_chat)]
+    rng.shuffle(order)
+    
+    # A reply is complete once its text (not the streaming placeholder) is delivered
+    by_key = {f"telegram:{chat.id}": chat for chat in fake_chats}
+    outbox_deliver = bot.outbox.deliver
+    
+    def deliver(chat_key, send, text):
+        future = outbox_deliver(chat_key, send, text)
+        if text != bot.PLACEHOLDER:
+            future.add_done_callback(
+                lambda f: f.cancelled() or f.exception() or by_key[chat_key].answered())
+        return future
+    bot.outbox.deliver = deliver
+    
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    next_at = loop.time()
+    for message_id, chat in enumerate(order, 1):
+        next_at += rng.expovariate(rate)
+        delay = next_at - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        chat.waiting.append(time.perf_counter())
+        await bot.handle_message(FakeTelegramUpdate(chat, chat.id, f"message {message_id}",
+                                                    message_id, network_latency), None)
+    sent_seconds = time.perf_counter() - started
+    
+    deadline = time.monotonic() + drain_timeout
+    while (bot.coalescer.pending or bot.dispatcher.depth or bot.dispatcher.busy
+           or bot.outbox.depth or bot.outbox.busy) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    await bot.dispatcher.stop()
+    await bot.outbox.stop()
+    
+    messages = len(order)
+    unanswered = sum(len(chat.waiting) for chat in fake_chats)
+    return {"messages": messages, "offered_rate": rate,
+            "send_seconds": round(sent_seconds, 2), "seconds": round(elapsed, 2),
+            "throughput_msgs_per_s": round((messages - unanswered) / elapsed, 1),
+            "replies": sum(chat.replies for chat in fake_chats),
+            "unanswered": unanswered, "latency": latency.snapshot()}
+
+def benchmark_telegram_load(chats: int = 2000, messages_per_chat: int = 3, rate: float = 400.0,
+                            latency: float = 0.2, jitter: float = 0.5, error_rate: float = 0.01,
+                            providers: int = 2, stream: bool = False, tokens_per_s: float = 50.0,
+                            workers: int = 128, coalesce_window: float = 0.5,
+                            network_latency: float = 0.02, send_rate: float = None,
+                            send_interval: float = 1.0, seed: int = 42) -> Dict[str, Any]:
+    """End-to-end load test: simulated Telegram chats against mock providers
+    
+    send_rate None drops Telegram's global send limit, to measure the bot itself.
+    """
+    import psutil
+    
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+    mocks = [MockProvider(latency, reply="sure, sounds good to me " * 4, jitter=jitter,
+                          error_rate=error_rate, tokens_per_s=tokens_per_s, name=f"mock{i}",
+                          seed=seed + i, max_concurrency=workers)
+             for i in range(providers)]
+    manager = AIManager(providers=mocks)
+    bot = TelegramBot('fake-token', manager, stream=stream,
+                      dispatcher=ChatDispatcher(workers=workers),
+                      outbox=DeliveryQueue('telegram', per_chat_interval=send_interval,
+                                           global_rate=send_rate, workers=workers),
+                      coalesce_window=coalesce_window, coalesce_max_wait=coalesce_window * 3)
+    
+    results = asyncio.run(simulate_telegram(bot, chats, messages_per_chat, rate, seed,
+                                            network_latency))
+    results["rss_growth_mb"] = round((process.memory_info().rss - rss_before) / (1024 * 1024), 1)
+    results["ai"] = {"requests": dict(manager.stats),
+                     "routed": dict(manager.router.routed),
+                     "errors": dict(manager.router.errors),
+                     "fallbacks": dict(manager.router.fallbacks)}
+    results["dispatch"] = bot.dispatcher.snapshot()
+    results["coalescing"] = bot.coalescer.snapshot()
+    results["delivery"] = bot.outbox.snapshot()
+    results["config"] = {"chats": chats, "messages_per_chat": messages_per_chat,
+                         "mock_latency_s": latency, "jitter": jitter, "error_rate": error_rate,
+                         "providers": providers, "stream": stream, "workers": workers,
+                         "coalesce_window_s": coalesce_window, "send_rate": send_rate,
+                         "send_interval_s": send_interval}
+    return results
+
+def benchmark_metrics(calls: int = 20000, rounds: int = 3) -> Dict[str, Any]:
+    """Per-reply cost of the /metrics histograms on the hot path, and scrape time"""
+    def unobserved() -> Histogram:
+        histogram = Histogram()
+        histogram.observe = lambda seconds: None  # this instance only
+        return histogram
+    
+    async def replies(instrumented: bool) -> tuple:
+        manager = AIManager(providers=[MockProvider(0.0, max_concurrency=1000)])
+        if not instrumented:
+            manager.stage_latency = defaultdict(unobserved)
+            manager.router.latency = defaultdict(unobserved)
+        started = time.perf_counter()
+        for _ in range(calls):
+            await manager.get_response("hello")
+        return (time.perf_counter() - started) / calls, manager
+    
+    with_metrics, without_metrics = [], []
+    for _ in range(rounds):
+        per_call, manager = asyncio.run(replies(True))
+        with_metrics.append(per_call)
+        without_metrics.append(asyncio.run(replies(False))[0])
+    
+    started = time.perf_counter()
+    text = collect_metrics(manager)
+    render_seconds = time.perf_counter() - started
+    
+    instrumented, bare = min(with_metrics), min(without_metrics)
+    return {"calls": calls,
+            "per_reply_us": round(instrumented * 1e6, 2),
+            "per_reply_us_uninstrumented": round(bare * 1e6, 2),
+            "overhead_us": round((instrumented - bare) * 1e6, 2),
+            "overhead_pct": round((instrumented - bare) / bare * 100, 2),
+            "scrape_ms": round(render_seconds * 1000, 2), "scrape_bytes": len(text)}
+
+def benchmark_rate_limit(rpm: float = 600.0, offered_rps: float = 15.0, duration: float = 10.0,
+                         background_share: float = 0.3, latency: float = 0.1,
+                         seed: int = 42) -> Dict[str, Any]:
+    """Bursts above a provider's rate limit, with and without the client-side scheduler
+    
+    The mock provider admits rpm (with one second of burst) and answers 429
+    beyond that. "naive" sends straight through as the bot did before;
+    "scheduled" budgets the same rpm locally and queues interactive first.
+    """
+    async def run(scheduled: bool) -> Dict[str, Any]:
+        ceiling = RateLimiter(rpm=rpm, burst=1.0)
+        limiter = RateLimiter(rpm=rpm, burst=1.0) if scheduled else None
+        mock = MockProvider(latency, server_limit=ceiling, max_concurrency=1000,
+                            limiter=limiter, max_rate_retries=3 if scheduled else 0)
+        manager = AIManager(providers=[mock])
+        rng = random.Random(seed)
+        latencies = {RateLimiter.INTERACTIVE: [], RateLimiter.BACKGROUND: []}
+        failed = defaultdict(int)
+        
+        async def one(i: int, priority: int):
+            started = time.monotonic()
+            reply = await manager.get_response(f"message {i}", priority=priority)
+            if reply == mock.reply:
+                latencies[priority].append(time.monotonic() - started)
+            else:
+                failed[priority] += 1
+        
+        tasks = []
+        started = time.monotonic()
+        for i in range(int(offered_rps * duration)):
+            priority = (RateLimiter.BACKGROUND if rng.random() < background_share
+                        else RateLimiter.INTERACTIVE)
+            tasks.append(asyncio.create_task(one(i, priority)))
+            await asyncio.sleep(rng.expovariate(offered_rps))
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - started
+        
+        completed = sum(len(values) for values in latencies.values())
+        result = {"offered": len(tasks), "completed": completed,
+                  "failed": sum(failed.values()),
+                  "provider_429s": mock.usage['rate_limited'],
+                  "throughput_rps": round(completed / elapsed, 2),
+                  "ceiling_rps": round(rpm / 60, 2)}
+        for priority, label in ((RateLimiter.INTERACTIVE, 'interactive'),
+                                (RateLimiter.BACKGROUND, 'background')):
+            window = LatencyWindow()
+            for value in latencies[priority]:
+                window.add(value)
+            result[label] = {"failed": failed[priority], "latency": window.snapshot()}
+        return result
+    
+    return {"naive": asyncio.run(run(False)), "scheduled": asyncio.run(run(True)),
+            "config": {"rpm": rpm, "offered_rps": offered_rps, "duration_s": duration,
+                       "background_share": background_share, "mock_latency_s": latency}}
+
+BENCHMARKS = {
+    'ingestion': benchmark_ingestion,
+    'example_index': benchmark_example_index,
+    'startup': benchmark_startup,
+    'server': benchmark_server,
+    'metrics': benchmark_metrics,
+    'telegram_load': benchmark_telegram_load,
+    'rate_limit': benchmark_rate_limit,
+}
+
+def flatten_numbers(data: Any, prefix: str = '') -> Dict[str, float]:
+    """Numeric leaves of nested results as dotted keys"""
+    if isinstance(data, dict):
+        flat = {}
+        for key, value in data.items():
+            flat.update(flatten_numbers(value, f"{prefix}{key}."))
+        return flat
+    if isinstance(data, (int, float)) and not isinstance(data, bool):
+        return {prefix.rstrip('.'): data}
+    return {}
+
+def compare_results(baseline: Dict[str, Any], results: Dict[str, Any]) -> Dict[str, Any]:
+    """Change of every numeric result against a saved run"""
+    old, new = flatten_numbers(baseline), flatten_numbers(results)
+    changes = {}
+    for key in sorted(old.keys() & new.keys()):
+        change = {"baseline": old[key], "current": new[key]}
+        if old[key]:
+            change["change_pct"] = round((new[key] - old[key]) / abs(old[key]) * 100, 1)
+        changes[key] = change
+    return changes
+
+def run_benchmark(name: str, params: Dict[str, Any] = None, save: str = None,
+                  compare: str = None) -> Dict[str, Any]:
+    """Run a named benchmark, print its results as JSON, and optionally save or compare them"""
+    params = params or {}
+    results = BENCHMARKS[name](**params)
+    report = {"benchmark": name, "params": params, "results": results,
+              "time": datetime.now().isoformat(timespec='seconds'),
+              "python": sys.version.split()[0], "platform": sys.platform}
+    
+    if compare:
+        with open(compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get("benchmark") != name:
+            logger.warning(f"Comparing {name} against a {baseline.get('benchmark')} run")
+        report["comparison"] = compare_results(baseline.get("results", {}), results)
+    
+    print(json.dumps(report, indent=2))
+    if save:
+        tmp = Path(save).with_suffix(Path(save).suffix + '.tmp')
+        tmp.write_text(json.dumps(report, indent=2), encoding='utf-8')
+        os.replace(tmp, save)
+    return results
+
@@ -0,0 +1,66 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from ai_chat_system import BrowserPool
+
+
+def offline_pool(tmp_path, **options):
+    """A pool whose 'browsers' are stand-ins, so no Chrome is needed"""
+    pool = BrowserPool(root=tmp_path / 'whatsapp_profiles',
+                       legacy_profile=tmp_path / 'whatsapp_profile', **options)
+    
+    def launch(session):
+        session.driver = SimpleNamespace(quit=lambda: None)
+        session.launches += 1
+    pool._launch = launch
+    return pool
+
+
+def run(pool, scenario):
+    async def main():
+        try:
+            return await scenario()
+        finally:
+            await pool.close()
+    return asyncio.run(main())
+
+
+def test_profiles_live_under_the_configured_directories(tmp_path):
+    pool = offline_pool(tmp_path)
+    
+    async def scenario():
+        default = await pool.acquire('default')
+        other = await pool.acquire('work/../phone')
+        return default.profile_dir, other.profile_dir
+    
+    default, other = run(pool, scenario)
+    assert default == tmp_path / 'whatsapp_profile'
+    assert other.parent == tmp_path / 'whatsapp_profiles'
+    assert '/' not in other.name and other.is_dir()
+
+
+def test_same_account_shares_a_browser(tmp_path):
+    pool = offline_pool(tmp_path)
+    
+    async def scenario():
+        first = await pool.acquire('a')
+        second = await pool.acquire('a')
+        return first is second, first.refs, first.launches
+    
+    assert run(pool, scenario) == (True, 2, 1)
+
+
+def test_full_pool_suspends_an_idle_session_or_refuses(tmp_path):
+    pool = offline_pool(tmp_path, max_sessions=1)
+    
+    async def scenario():
+        a = await pool.acquire('a')
+        with pytest.raises(RuntimeError):
+            await pool.acquire('b')  # a is still held
+        await pool.release(a)
+        b = await pool.acquire('b')
+        return a.live, b.live, pool.stats['suspended']
+    
+    assert run(pool, scenario) == (False, True, 1)
@@ -0,0 +1,51 @@
+import asyncio
+
+from ai_chat_system import MessageCoalescer
+
+
+def collect(window, max_wait, schedule):
+    """Feed (delay, key, item) triples to a coalescer and return its batches"""
+    async def run():
+        batches = []
+        coalescer = MessageCoalescer(lambda key, items: batches.append((key, items)),
+                                     window, max_wait)
+        for delay, key, item in schedule:
+            await asyncio.sleep(delay)
+            coalescer.add(key, item)
+        await asyncio.sleep(max(window, max_wait) + 0.05)
+        return batches, coalescer
+    return asyncio.run(run())
+
+
+def test_zero_window_flushes_every_message_at_once():
+    batches, _ = collect(0.0, 0.0, [(0, "a", 1), (0, "a", 2)])
+    assert batches == [("a", [1]), ("a", [2])]
+
+
+def test_burst_from_one_sender_becomes_one_batch():
+    batches, coalescer = collect(0.05, 1.0, [(0, "a", 1), (0.01, "a", 2), (0.01, "a", 3)])
+    assert batches == [("a", [1, 2, 3])]
+    assert coalescer.stats['batches'] == 1
+
+
+def test_senders_are_batched_separately():
+    batches, _ = collect(0.05, 1.0, [(0, "a", 1), (0, "b", 2), (0.01, "a", 3)])
+    assert sorted(batches) == [("a", [1, 3]), ("b", [2])]
+
+
+def test_max_wait_caps_a_long_burst():
+    schedule = [(0, "a", 0)] + [(0.03, "a", i) for i in range(1, 8)]
+    batches, _ = collect(0.05, 0.1, schedule)
+    assert len(batches) > 1
+    assert [item for _, items in batches for item in items] == list(range(8))
+
+
+def test_clear_drops_pending_bursts():
+    async def run():
+        batches = []
+        coalescer = MessageCoalescer(lambda key, items: batches.append(items), 0.05, 1.0)
+        coalescer.add("a", 1)
+        coalescer.clear()
+        await asyncio.sleep(0.1)
+        return batches, coalescer.pending
+    assert asyncio.run(run()) == ([], {})
@@ -0,0 +1,146 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from ai_chat_system import DeliveryQueue, flood_wait, split_message
+
+
+class RetryAfter(Exception):
+    def __init__(self, seconds):
+        super().__init__("flood control")
+        self.retry_after = timedelta(seconds=seconds)
+
+
+class NetworkError(Exception):
+    pass
+
+
+class BadRequest(Exception):
+    pass
+
+
+def test_split_message_keeps_short_text_whole():
+    assert split_message("hello", 10) == ["hello"]
+    assert split_message("", 10) == []
+
+
+def test_split_message_prefers_paragraphs_then_words():
+    text = "first paragraph\n\nsecond one"
+    assert split_message(text, 20) == ["first paragraph", "second one"]
+    parts = split_message("word " * 50, 32)
+    assert all(len(part) <= 32 for part in parts)
+    assert ' '.join(parts).split() == ["word"] * 50
+
+
+def test_split_message_cuts_unbroken_text():
+    parts = split_message("x" * 25, 10)
+    assert parts == ["x" * 10, "x" * 10, "x" * 5]
+
+
+def test_flood_wait_reads_timedelta_and_seconds():
+    assert flood_wait(RetryAfter(3)) == 3.0
+    error = Exception()
+    error.retry_after = 2
+    assert flood_wait(error) == 2.0
+    assert flood_wait(ValueError()) is None
+
+
+def run_queue(scenario, **options):
+    async def run():
+        queue = DeliveryQueue('test', **{'per_chat_interval': 0.0, 'global_rate': None,
+                                         'backoff': 0.01, **options})
+        try:
+            return await scenario(queue)
+        finally:
+            await queue.stop()
+    return asyncio.run(run())
+
+
+def test_messages_to_one_chat_stay_in_order():
+    sent = []
+    
+    async def send(chunk):
+        await asyncio.sleep(0.001)
+        sent.append(chunk)
+        return chunk
+    
+    async def scenario(queue):
+        futures = [queue.deliver('chat', send, f"message {i}") for i in range(20)]
+        await asyncio.gather(*futures)
+    
+    run_queue(scenario)
+    assert sent == [f"message {i}" for i in range(20)]
+
+
+def test_long_text_resolves_to_every_part():
+    async def send(chunk):
+        return chunk
+    
+    async def scenario(queue):
+        return await queue.deliver('chat', send, "abcdefghij" * 3)
+    
+    assert run_queue(scenario, max_length=10) == ["abcdefghij"] * 3
+
+
+def test_flood_wait_holds_only_its_chat():
+    sent = []
+    failed = {'a': True}
+    
+    async def send_to(chat):
+        async def send(chunk):
+            if failed.pop(chat, False):
+                raise RetryAfter(0.2)
+            sent.append(chat)
+            return chunk
+        return send
+    
+    async def scenario(queue):
+        a = queue.deliver('a', await send_to('a'), "to a")
+        b = queue.deliver('b', await send_to('b'), "to b")
+        await asyncio.gather(a, b)
+        return queue.stats['flood_waits']
+    
+    assert run_queue(scenario) == 1
+    assert sent == ['b', 'a']
+
+
+def test_transient_errors_retry_and_permanent_ones_fail():
+    attempts = []
+    
+    async def flaky(chunk):
+        attempts.append(chunk)
+        if len(attempts) < 3:
+            raise NetworkError("connection reset")
+        return chunk
+    
+    async def rejected(chunk):
+        raise BadRequest("chat not found")
+    
+    async def scenario(queue):
+        assert await queue.deliver('a', flaky, "hello") == ["hello"]
+        with pytest.raises(BadRequest):
+            await queue.deliver('b', rejected, "hello")
+        return dict(queue.stats)
+    
+    stats = run_queue(scenario)
+    assert len(attempts) == 3
+    assert stats['retries'] == 2
+    assert stats['failed'] == 1
+
+
+def test_try_claim_respects_queued_messages_and_flood_waits():
+    async def scenario(queue):
+        assert queue.try_claim('a')
+        assert not queue.try_claim('a')  # inside its per-chat interval
+        
+        async def slow(chunk):
+            await asyncio.sleep(0.05)
+        
+        queue.deliver('b', slow, "queued")
+        assert not queue.try_claim('b')
+        
+        queue.hold('c', 1.0)
+        return queue.try_claim('c')
+    
+    assert run_queue(scenario, per_chat_interval=1.0) is False
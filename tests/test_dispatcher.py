@@ -0,0 +1,79 @@
+import asyncio
+
+from ai_chat_system import ChatDispatcher
+
+
+def test_jobs_for_one_chat_run_in_order_one_at_a_time():
+    async def scenario():
+        dispatcher = ChatDispatcher(workers=4)
+        order, running = [], []
+
+        def job(i):
+            async def run():
+                running.append(i)
+                assert len(running) == 1
+                await asyncio.sleep(0.01 * (5 - i))
+                order.append(i)
+                running.remove(i)
+            return run
+
+        for i in range(5):
+            assert dispatcher.submit("chat", job(i))
+        while dispatcher.stats['processed'] < 5:
+            await asyncio.sleep(0.01)
+        await dispatcher.stop()
+        return order
+
+    assert asyncio.run(scenario()) == [0, 1, 2, 3, 4]
+
+
+def test_different_chats_are_served_concurrently():
+    async def scenario():
+        dispatcher = ChatDispatcher(workers=3)
+        started = asyncio.Event()
+        release = asyncio.Event()
+        peak = 0
+
+        async def job():
+            nonlocal peak
+            peak = max(peak, dispatcher.busy)
+            if dispatcher.busy == 3:
+                started.set()
+            await release.wait()
+
+        for chat in ("a", "b", "c"):
+            dispatcher.submit(chat, job)
+        await asyncio.wait_for(started.wait(), 1)
+        release.set()
+        while dispatcher.stats['processed'] < 3:
+            await asyncio.sleep(0.01)
+        await dispatcher.stop()
+        return peak
+
+    assert asyncio.run(scenario()) == 3
+
+
+def test_full_chat_sheds_by_policy():
+    async def scenario(policy):
+        dispatcher = ChatDispatcher(workers=1, max_chat_depth=2, shed_policy=policy)
+        gate = asyncio.Event()
+        ran = []
+
+        def job(i):
+            async def run():
+                if i == 0:
+                    await gate.wait()
+                ran.append(i)
+            return run
+
+        dispatcher.submit("busy", job(0))
+        await asyncio.sleep(0)  # the worker picks up job 0 and blocks
+        accepted = [dispatcher.submit("busy", job(i)) for i in (1, 2, 3)]
+        gate.set()
+        while dispatcher.depth or dispatcher.busy:
+            await asyncio.sleep(0.01)
+        await dispatcher.stop()
+        return accepted, ran, dispatcher.stats['shed_chat']
+
+    assert asyncio.run(scenario("drop_oldest")) == ([True, True, True], [0, 2, 3], 1)
+    assert asyncio.run(scenario("drop_newest")) == ([True, True, False], [0, 1, 2], 1)
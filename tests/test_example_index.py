@@ -0,0 +1,47 @@
+from ai_chat_system import ExampleIndex, PersonalityCloner
+
+PAIRS = [
+    ("are you coming to the party tonight?", "wouldn't miss it"),
+    ("did you feed the cat", "yes twice"),
+    ("what time is the party", "eight-ish"),
+    ("how was work", "long"),
+    ("!!!", "skipped, no words"),
+]
+
+
+def test_build_skips_pairs_without_words():
+    index = ExampleIndex.build(PAIRS)
+    assert len(index) == 4
+    assert "party" in index.vocab
+
+
+def test_search_ranks_matching_pairs_first():
+    index = ExampleIndex.build(PAIRS)
+    results = index.search("party tonight", k=3)
+    assert [incoming for _, incoming, _ in results] == [
+        "are you coming to the party tonight?", "what time is the party"]
+    assert results[0][0] > results[1][0] > 0
+    assert index.search("unrelated words") == []
+
+
+def test_select_respects_k_and_budget():
+    index = ExampleIndex.build(PAIRS)
+    assert index.select("party", k=1) == [("what time is the party", "eight-ish")]
+    # The shorter pair still fits once the longer one is over budget
+    assert index.select("party tonight", budget=35) == [("what time is the party", "eight-ish")]
+    assert index.select("party", budget=5) == []
+
+
+def test_empty_index_finds_nothing():
+    index = ExampleIndex.build([])
+    assert len(index) == 0
+    assert index.select("anything") == []
+
+
+def test_cloner_retrieves_learned_examples():
+    cloner = PersonalityCloner("Me")
+    cloner.learn_messages([
+        ("Ann", "did you feed the cat", None), ("Me", "yes twice", None),
+        ("Ann", "how was work", None), ("Me", "long", None),
+    ])
+    assert cloner.find_examples("the cat looks hungry") == [("did you feed the cat", "yes twice")]
@@ -0,0 +1,67 @@
+import io
+import json
+from datetime import datetime
+
+from ai_chat_system import (
+    PersonalityCloner, iter_plain_chat, iter_telegram_export, iter_whatsapp_export,
+    parse_whatsapp_timestamp
+)
+
+
+def test_whatsapp_timestamps_in_both_orders_and_clocks():
+    assert parse_whatsapp_timestamp("12/31/20", "9:41 PM") == datetime(2020, 12, 31, 21, 41)
+    assert parse_whatsapp_timestamp("31/12/2020", "21:41:05") == datetime(2020, 12, 31, 21, 41, 5)
+    assert parse_whatsapp_timestamp("03/04/21", "12:05 am", dayfirst=True) == datetime(2021, 4, 3, 0, 5)
+    assert parse_whatsapp_timestamp("2020-12-31", "09:41") == datetime(2020, 12, 31, 9, 41)
+    assert parse_whatsapp_timestamp("13/13/20", "10:00") is None
+
+
+def test_whatsapp_export_joins_continuation_lines_and_skips_notices():
+    lines = [
+        "12/31/20, 9:41 PM - Messages to this group are now secured with end-to-end encryption\n",
+        "12/31/20, 9:42 PM - Alex: happy new year\n",
+        "see you soon\n",
+        "[31/12/2020, 21:43:00] Sam: you too\n",
+    ]
+    messages = list(iter_whatsapp_export(lines))
+    assert [(sender, text) for sender, text, _ in messages] == [
+        ("Alex", "happy new year\nsee you soon"),
+        ("Sam", "you too"),
+    ]
+    assert messages[0][2] == datetime(2020, 12, 31, 21, 42)
+
+
+def test_plain_chat_lines():
+    assert list(iter_plain_chat(["Alex: hi\n", "no separator\n", "Sam: a: b\n"])) == [
+        ("Alex", "hi", None), ("Sam", "a: b", None)]
+
+
+def test_telegram_export_streams_across_chunks():
+    export = {"name": "chat", "messages": [
+        {"id": 1, "type": "service", "actor": "Alex"},
+        {"id": 2, "type": "message", "date": "2023-05-01T12:00:00", "from": "Alex",
+         "text": ["see ", {"type": "link", "text": "this"}]},
+        {"id": 3, "type": "message", "date": "bad date", "from": "Sam", "text": "ok"},
+        {"id": 4, "type": "message", "from": "Sam", "text": ""},
+    ]}
+    messages = list(iter_telegram_export(io.StringIO(json.dumps(export)), chunk_size=16))
+    assert messages == [("Alex", "see this", datetime(2023, 5, 1, 12, 0)), ("Sam", "ok", None)]
+
+
+def test_full_telegram_export_with_several_chats():
+    export = {"chats": {"list": [
+        {"name": "a", "messages": [{"type": "message", "from": "Alex", "text": "one"}]},
+        {"name": "b", "messages": [{"type": "message", "from": "Sam", "text": "two"}]},
+    ]}}
+    messages = list(iter_telegram_export(io.StringIO(json.dumps(export)), chunk_size=8))
+    assert [text for _, text, _ in messages] == ["one", "two"]
+
+
+def test_learn_from_file_guesses_the_format(tmp_path):
+    path = tmp_path / "chat.txt"
+    path.write_text("1/2/23, 10:00 AM - Sam: how are you?\n"
+                    "1/2/23, 10:01 AM - Alex: great, thanks 😀\n", encoding="utf-8")
+    cloner = PersonalityCloner("Alex")
+    cloner.learn_from_file(path)
+    assert cloner.stats['messages'] == 2
+    assert cloner.stats['own_messages'] == 1
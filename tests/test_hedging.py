@@ -0,0 +1,61 @@
+import asyncio
+
+from ai_chat_system import ProviderRouter
+from benchmarks import MockProvider
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+def hedged_router():
+    slow = MockProvider(0.5, reply="slow", name="slow")
+    fast = MockProvider(0.01, reply="fast", name="fast")
+    return ProviderRouter([slow, fast], hedge_min_delay=0.05, hedge_default_delay=0.05)
+
+
+def test_hedge_returns_the_first_success_and_cancels_the_loser():
+    router = hedged_router()
+    provider, reply = asyncio.run(router.call_hedged('complete', MESSAGES))
+    assert (provider.name, reply) == ("fast", "fast")
+    assert router.hedge_stats['fired'] == 1
+    assert router.hedge_stats['cancelled'] == 1
+    assert router.hedge_wins == {"fast": 1}
+    # The loser never finished, so it used nothing and didn't count as an error
+    assert router.providers[0].usage['calls'] == 0
+    assert router.errors["slow"] == 0
+
+
+def test_cancelled_loser_keeps_a_censored_latency_sample():
+    router = hedged_router()
+    asyncio.run(router.call_hedged('complete', MESSAGES))
+    slow = router.health["slow"]
+    assert slow.state == slow.CLOSED
+    assert slow.error_rate == 0.0
+    # At least the hedge delay it was given before the hedge fired
+    assert slow.latency(0.9) >= 0.05
+    assert router.hedge_delay(router.providers[0]) >= 0.05
+
+
+def test_no_hedge_when_the_first_provider_is_fast():
+    router = ProviderRouter([MockProvider(0.0, reply="a", name="a"),
+                             MockProvider(0.0, reply="b", name="b")],
+                            hedge_min_delay=0.2)
+    provider, reply = asyncio.run(router.call_hedged('complete', MESSAGES))
+    assert reply == "a"
+    assert router.hedge_stats['fired'] == 0
+    assert router.hedge_stats['cancelled'] == 0
+
+
+def test_hedged_stream_open_closes_the_losing_stream():
+    slow = MockProvider(0.5, reply="slow reply", name="slow", tokens_per_s=100)
+    fast = MockProvider(0.01, reply="fast reply", name="fast", tokens_per_s=100)
+    router = ProviderRouter([slow, fast], hedge_min_delay=0.05, hedge_default_delay=0.05)
+    
+    async def run():
+        provider, chunks, first, started = await router.open_stream(MESSAGES, hedge=True)
+        rest = [chunk async for chunk in chunks]
+        router.finish_stream(provider, started, True)
+        return provider.name, first + ''.join(rest)
+    
+    assert asyncio.run(run()) == ("fast", "fast reply")
+    assert router.hedge_stats['cancelled'] == 1
+    assert router.health["slow"].latency(0.5) >= 0.05
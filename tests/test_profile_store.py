@@ -0,0 +1,47 @@
+import pytest
+
+from ai_chat_system import ProfileStore
+
+
+def learn(store, messages):
+    cloner = store.get("Me")
+    cloner.learn_messages((sender, text, None) for sender, text in messages)
+    return cloner
+
+
+def test_profile_survives_a_reopen(tmp_path):
+    path = tmp_path / "profiles.db"
+    store = ProfileStore(path)
+    learn(store, [("Bob", "coming tonight?"), ("Me", "yes 😀"), ("Me", "yes 😀")])
+    store.close()
+
+    reopened = ProfileStore(path)
+    cloner = reopened.get("Me")
+    assert cloner.data["phrases"] == ["yes 😀"]
+    assert cloner.data["emojis"] == {"😀": 2}
+    assert cloner.version == 1
+    assert cloner.stats['own_messages'] == 2
+    assert list(cloner.example_pairs()) == [("coming tonight?", "yes 😀")]
+    assert reopened.names() == ["Me"]
+    reopened.close()
+
+
+def test_relearning_merges_counts_and_bumps_version(tmp_path):
+    path = tmp_path / "profiles.db"
+    store = ProfileStore(path)
+    learn(store, [("Me", "ok 😂")])
+    learn(store, [("Me", "ok 😂"), ("Me", "later")])
+    store.close()
+
+    cloner = ProfileStore(path).get("Me")
+    assert cloner.data["phrases"] == ["ok 😂", "later"]
+    assert cloner.data["emojis"] == {"😂": 2}
+    assert cloner.version == 2
+
+
+def test_readonly_store_refuses_writes(tmp_path):
+    path = tmp_path / "profiles.db"
+    ProfileStore(path).close()
+    readonly = ProfileStore(path, readonly=True)
+    with pytest.raises(RuntimeError):
+        learn(readonly, [("Me", "hi")])
@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+import pytest
+
+from ai_chat_system import RateLimited, RateLimiter, rate_limit_retry_after
+from benchmarks import MockProvider
+
+
+def test_unlimited_limiter_never_waits():
+    limiter = RateLimiter()
+    assert all(limiter.try_acquire(1000) == 0.0 for _ in range(100))
+
+
+def test_burst_then_refill():
+    limiter = RateLimiter(rpm=60, burst=2.0)  # two requests of burst, one per second
+    assert limiter.try_acquire() == 0.0
+    assert limiter.try_acquire() == 0.0
+    delay = limiter.try_acquire()
+    assert 0.0 < delay <= 1.0
+
+
+def test_token_budget():
+    limiter = RateLimiter(tpm=600, burst=1.0)  # ten tokens of capacity
+    assert limiter.try_acquire(10) == 0.0
+    assert limiter.try_acquire(5) > 0.0
+
+
+def test_pause_holds_every_request():
+    limiter = RateLimiter()
+    limiter.pause(0.5)
+    assert limiter.try_acquire() > 0.0
+
+
+def test_interactive_requests_go_before_background():
+    async def run():
+        limiter = RateLimiter(rpm=600, burst=0.1)  # one request, refilled every 0.1s
+        assert limiter.try_acquire() == 0.0
+        order = []
+        
+        async def request(name, priority):
+            await limiter.acquire(priority=priority)
+            order.append(name)
+        
+        background = asyncio.create_task(request('background', RateLimiter.BACKGROUND))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(request('interactive', RateLimiter.INTERACTIVE))
+        await asyncio.gather(background, interactive)
+        return order
+    
+    assert asyncio.run(run()) == ['interactive', 'background']
+
+
+def test_acquire_gives_up_after_max_wait():
+    async def run():
+        limiter = RateLimiter(rpm=6, burst=10.0, max_wait=0.05)  # one request per 10s
+        await limiter.acquire()
+        started = time.monotonic()
+        with pytest.raises(RateLimited):
+            await limiter.acquire()
+        return time.monotonic() - started
+    
+    assert asyncio.run(run()) < 1.0
+
+
+def test_retry_after_header():
+    class Error(Exception):
+        status_code = 429
+        
+        def __init__(self, headers):
+            self.response = type('Response', (), {'headers': headers})()
+    
+    assert rate_limit_retry_after(Error({'retry-after': '2.5'})) == 2.5
+    assert rate_limit_retry_after(Error({'retry-after-ms': '250'})) == 0.25
+    assert rate_limit_retry_after(Error({}), default=7.0) == 7.0
+    assert rate_limit_retry_after(ValueError("not a 429")) is None
+
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+def provider_with_budget(**options):
+    limiter = RateLimiter(tpm=6000)  # 6000 tokens of burst, refilled at 100/s
+    return MockProvider(limiter=limiter, max_rate_retries=0, **options), limiter
+
+
+def test_failed_call_gives_its_reservation_back():
+    provider, limiter = provider_with_budget(latency=0.0, error_rate=1.0)
+    with pytest.raises(RuntimeError):
+        asyncio.run(provider.complete(MESSAGES))
+    assert limiter.snapshot()['available_tokens'] == 6000
+
+
+def test_timed_out_call_gives_its_reservation_back():
+    provider, limiter = provider_with_budget(latency=1.0, timeout=0.05)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(provider.complete(MESSAGES))
+    assert limiter.snapshot()['available_tokens'] == 6000
+
+
+def test_cancelled_call_gives_its_reservation_back():
+    provider, limiter = provider_with_budget(latency=1.0)
+    
+    async def run():
+        task = asyncio.create_task(provider.complete(MESSAGES))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    
+    asyncio.run(run())
+    assert limiter.snapshot()['available_tokens'] == 6000
+
+
+def test_failed_stream_gives_its_reservation_back():
+    provider, limiter = provider_with_budget(latency=0.0, error_rate=1.0, tokens_per_s=100)
+    
+    async def run():
+        return [chunk async for chunk in provider.stream(MESSAGES)]
+    
+    with pytest.raises(RuntimeError):
+        asyncio.run(run())
+    assert limiter.snapshot()['available_tokens'] == 6000
+
+
+def test_successful_call_keeps_only_what_it_used():
+    provider, limiter = provider_with_budget(latency=0.0, reply="word " * 40)
+    asyncio.run(provider.complete(MESSAGES, max_tokens=150))
+    # The prompt and the reply (about 50 tokens) stay spent until the bucket refills
+    assert 5900 < limiter.snapshot()['available_tokens'] < 5960
@@ -0,0 +1,60 @@
+import json
+import time
+
+from ai_chat_system import ResponseCache
+
+
+def test_key_normalizes_message_text():
+    assert (ResponseCache.make_key("Hello   World", "assistant") ==
+            ResponseCache.make_key(" hello world ", "assistant"))
+
+
+def test_key_separates_mode_personality_and_history():
+    base = ResponseCache.make_key("why?", "assistant")
+    assert ResponseCache.make_key("why?", "human") != base
+    assert ResponseCache.make_key("why?", "assistant", {"name": "Sam", "version": 1}) != base
+    
+    history = [{"role": "user", "content": "the sky is blue"},
+               {"role": "assistant", "content": "it is"}]
+    other = [{"role": "user", "content": "grass is green"},
+             {"role": "assistant", "content": "it is"}]
+    assert ResponseCache.make_key("why?", "assistant", history=history) != base
+    assert (ResponseCache.make_key("why?", "assistant", history=history) !=
+            ResponseCache.make_key("why?", "assistant", history=other))
+
+
+def test_versioned_profiles_key_on_version():
+    v1 = ResponseCache.make_key("hi", "human", {"name": "Sam", "version": 1, "tone": "dry"})
+    v1_again = ResponseCache.make_key("hi", "human", {"name": "Sam", "version": 1, "tone": "warm"})
+    v2 = ResponseCache.make_key("hi", "human", {"name": "Sam", "version": 2, "tone": "dry"})
+    assert v1 == v1_again
+    assert v1 != v2
+
+
+def test_lru_eviction_and_ttl():
+    cache = ResponseCache(max_entries=2, ttl=60)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"  # a is now the most recently used
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.stats['evicted'] == 1
+    
+    cache.entries["a"] = (time.time() - 1, "1")
+    assert cache.get("a") is None
+    assert cache.stats['expired'] == 1
+
+
+def test_persists_as_json_and_ignores_bad_entries(tmp_path):
+    path = tmp_path / "cache.json"
+    cache = ResponseCache(path=path)
+    cache.put("key", "reply")
+    cache.save()
+    assert json.loads(path.read_text())[0][::2] == ["key", "reply"]
+    
+    entries = json.loads(path.read_text())
+    entries.append(["stale", time.time() - 10, "old"])
+    entries.append({"not": "a list"})
+    path.write_text(json.dumps(entries))
+    loaded = ResponseCache(path=path)
+    assert list(loaded.entries) == ["key"]
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from ai_chat_system import AIManager, NoProviderAvailable, ProviderHealth, ProviderRouter
+from benchmarks import MockProvider
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+def test_untried_provider_scores_the_prior():
+    health = ProviderHealth(prior_latency=2.0)
+    assert health.score == 2.0
+    health.record(0.5, True)
+    assert health.score == 0.5
+
+
+def test_breaker_opens_after_consecutive_failures_and_probes_after_cooldown():
+    health = ProviderHealth(max_consecutive_failures=2, cooldown=0.0)
+    health.record(1.0, False)
+    assert health.state == ProviderHealth.CLOSED
+    health.record(1.0, False)
+    assert health.state == ProviderHealth.OPEN
+    
+    assert health.try_acquire()  # cooled down: one half-open trial
+    assert health.state == ProviderHealth.HALF_OPEN
+    assert not health.try_acquire()
+    health.record(0.1, True)
+    assert health.state == ProviderHealth.CLOSED
+
+
+def test_open_breaker_refuses_requests_while_cooling_down():
+    health = ProviderHealth(max_consecutive_failures=1, cooldown=60.0)
+    health.record(1.0, False)
+    assert not health.try_acquire()
+    assert health.rank == 2
+
+
+def test_router_falls_back_to_the_next_provider():
+    broken = MockProvider(0.0, error_rate=1.0, name="broken")
+    working = MockProvider(0.0, reply="ok", name="working")
+    router = ProviderRouter([broken, working])
+    
+    provider, reply = asyncio.run(router.call('complete', MESSAGES))
+    assert (provider.name, reply) == ("working", "ok")
+    assert router.fallbacks["working"] == 1
+    assert router.errors["broken"] == 1
+
+
+def test_router_prefers_the_healthier_provider():
+    slow = MockProvider(0.0, name="slow")
+    fast = MockProvider(0.0, name="fast")
+    router = ProviderRouter([slow, fast])
+    for _ in range(5):
+        router.health["slow"].record(1.5, True)
+        router.health["fast"].record(0.1, True)
+    assert [p.name for p in router.candidates()] == ["fast", "slow"]
+
+
+def test_router_skips_open_breakers_and_raises_when_none_left():
+    broken = MockProvider(0.0, error_rate=1.0, name="broken")
+    router = ProviderRouter([broken], max_consecutive_failures=1, cooldown=60.0)
+    with pytest.raises(NoProviderAvailable):
+        asyncio.run(router.call('complete', MESSAGES))
+    with pytest.raises(NoProviderAvailable):
+        asyncio.run(router.call('complete', MESSAGES))
+    assert router.last_route == ["broken:skipped(open)"]
+
+
+def test_manager_answers_through_the_router():
+    manager = AIManager(providers=[MockProvider(0.0, error_rate=1.0, name="broken"),
+                                   MockProvider(0.0, reply="fine", name="working")])
+    assert asyncio.run(manager.get_response("hi", chat_key="test:1")) == "fine"
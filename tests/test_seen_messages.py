@@ -0,0 +1,55 @@
+import ai_chat_system
+from ai_chat_system import SeenMessages, WhatsAppBot
+
+
+def test_check_and_add_reports_duplicates_per_chat():
+    seen = SeenMessages()
+    assert seen.check_and_add("alice", "m1")
+    assert not seen.check_and_add("alice", "m1")
+    assert seen.check_and_add("bob", "m1")
+    assert seen.stats['duplicates'] == 1
+
+
+def test_membership_does_not_record():
+    seen = SeenMessages()
+    assert ("alice", "m1") not in seen
+    assert ("alice", "m1") not in seen
+    seen.check_and_add("alice", "m1")
+    assert ("alice", "m1") in seen
+
+
+def test_bounded_per_chat_and_per_chat_count():
+    seen = SeenMessages(per_chat=3, max_chats=2)
+    for i in range(5):
+        seen.check_and_add("alice", f"m{i}")
+    assert list(seen.chats["alice"]) == ["m2", "m3", "m4"]
+    
+    seen.check_and_add("bob", "x")
+    seen.check_and_add("carol", "x")
+    assert list(seen.chats) == ["bob", "carol"]
+
+
+def test_checkpoint_round_trip(tmp_path):
+    path = tmp_path / "seen.json"
+    seen = SeenMessages(path, save_every=2)
+    seen.check_and_add("alice", "m1")
+    assert not path.exists()
+    seen.check_and_add("alice", "m2")  # second new id triggers a checkpoint
+    assert path.exists()
+    
+    restored = SeenMessages(path)
+    assert ("alice", "m2") in restored
+    assert not restored.check_and_add("alice", "m1")
+
+
+def test_corrupt_checkpoint_starts_empty(tmp_path):
+    path = tmp_path / "seen.json"
+    path.write_text("{not json")
+    assert SeenMessages(path).chats == {}
+
+
+def test_whatsapp_seen_file_stays_in_the_data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(ai_chat_system, 'data_dir', tmp_path)
+    path = WhatsAppBot.seen_path('../work phone')
+    assert path.parent == tmp_path
+    assert path.name == 'whatsapp_seen____work_phone.json'
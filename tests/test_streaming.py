@@ -0,0 +1,105 @@
+import asyncio
+from types import SimpleNamespace
+
+from ai_chat_system import AIManager, DeliveryQueue, TelegramBot
+from benchmarks import MockProvider
+
+REPLY = "one two three four five six"
+
+
+def streaming_manager(**options):
+    return AIManager(providers=[MockProvider(0.0, reply=REPLY, tokens_per_s=200, **options)])
+
+
+def test_stream_response_yields_the_whole_reply_and_remembers_it():
+    manager = streaming_manager()
+    
+    async def run():
+        return [chunk async for chunk in manager.stream_response("hi", chat_key="test:1")]
+    
+    chunks = asyncio.run(run())
+    assert len(chunks) > 1
+    assert ''.join(chunks) == REPLY
+    assert manager.stage_latency['first_token'].count == 1
+    assert manager.stage_latency['response'].count == 1
+    history = manager.memory.build_messages("test:1", "next")
+    assert history[-2]['content'] == REPLY
+
+
+def test_stream_response_falls_back_when_the_first_provider_fails():
+    manager = AIManager(providers=[MockProvider(0.0, error_rate=1.0, name="broken",
+                                                tokens_per_s=200),
+                                   MockProvider(0.0, reply=REPLY, name="working",
+                                                tokens_per_s=200)])
+    
+    async def run():
+        return ''.join([chunk async for chunk in manager.stream_response("hi")])
+    
+    assert asyncio.run(run()) == REPLY
+    assert manager.router.fallbacks["working"] == 1
+
+
+class Message:
+    """The bot's sent message; records edits"""
+    def __init__(self, chat, fail_edits=False):
+        self.chat = chat
+        self.fail_edits = fail_edits
+    
+    async def edit_text(self, text):
+        if self.fail_edits:
+            raise RuntimeError("edit failed")
+        self.chat.append(('edit', text))
+        return self
+
+
+class Incoming:
+    """The user's message the bot replies to"""
+    message_id = 1
+    
+    def __init__(self, fail_edits=False):
+        self.chat = []
+        self.fail_edits = fail_edits
+    
+    async def reply_text(self, text):
+        self.chat.append(('reply', text))
+        return Message(self.chat, self.fail_edits)
+
+
+def stream_reply(per_chat_interval, fail_edits=False):
+    async def run():
+        manager = streaming_manager()
+        bot = TelegramBot('token', manager, edit_interval=0.0,
+                          outbox=DeliveryQueue('telegram', per_chat_interval=per_chat_interval,
+                                               global_rate=None, backoff=0.01, max_attempts=1))
+        incoming = Incoming(fail_edits)
+        try:
+            response = await bot.stream_reply(SimpleNamespace(message=incoming), "hi", "Sam",
+                                              "telegram:1")
+            while bot.outbox.depth or bot.outbox.busy:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.01)
+        finally:
+            await bot.outbox.stop()
+        return response, incoming.chat, manager
+    return asyncio.run(run())
+
+
+def test_stream_reply_edits_the_placeholder_into_the_reply():
+    response, chat, manager = stream_reply(per_chat_interval=0.0)
+    assert response == REPLY
+    assert chat[0] == ('reply', TelegramBot.PLACEHOLDER)
+    assert chat[-1] == ('edit', REPLY)
+    assert manager.stage_latency['first_visible_token'].count == 1
+
+
+def test_first_visible_token_counts_the_final_edit_when_live_edits_are_throttled():
+    # The placeholder uses the chat's slot, so no live edit can claim one
+    response, chat, manager = stream_reply(per_chat_interval=0.5)
+    assert chat == [('reply', TelegramBot.PLACEHOLDER), ('edit', REPLY)]
+    assert manager.stage_latency['first_visible_token'].count == 1
+
+
+def test_first_visible_token_is_not_recorded_when_nothing_was_shown():
+    response, chat, manager = stream_reply(per_chat_interval=0.0, fail_edits=True)
+    assert chat == [('reply', TelegramBot.PLACEHOLDER)]
+    assert manager.stage_latency['first_visible_token'].count == 0
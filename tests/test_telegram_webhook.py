@@ -0,0 +1,66 @@
+import asyncio
+import threading
+
+import pytest
+
+import ai_chat_system
+from ai_chat_system import TelegramBot
+
+HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+@pytest.fixture
+def webhook_bot(monkeypatch):
+    """A webhook-mode bot whose loop runs in a thread and records fed updates"""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    bot = TelegramBot("token", ai_manager=None, webhook=True, webhook_secret="s3cret")
+    bot.loop = loop
+    bot.fed = []
+    fed = threading.Event()
+
+    async def feed(payload):
+        bot.fed.append(payload)
+        fed.set()
+
+    bot._feed_update = feed
+    bot.wait_fed = lambda: fed.wait(1)
+    monkeypatch.setitem(ai_chat_system.active_bots, 'telegram', bot)
+    yield bot
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(1)
+    loop.close()
+
+
+def post(payload, secret=None):
+    headers = {HEADER: secret} if secret is not None else {}
+    client = ai_chat_system.app.test_client()
+    return client.post('/telegram/webhook', json=payload, headers=headers)
+
+
+def test_update_with_the_secret_is_queued(webhook_bot):
+    response = post({"update_id": 7, "message": {}}, secret="s3cret")
+    assert response.status_code == 200
+    assert response.get_json() == {"ok": True}
+    assert webhook_bot.wait_fed()
+    assert webhook_bot.fed == [{"update_id": 7, "message": {}}]
+
+
+@pytest.mark.parametrize("secret", [None, "", "wrong"])
+def test_missing_or_wrong_secret_is_rejected(webhook_bot, secret):
+    response = post({"update_id": 7}, secret=secret)
+    assert response.status_code == 403
+    assert webhook_bot.fed == []
+
+
+def test_non_update_body_is_rejected(webhook_bot):
+    assert post({"hello": 1}, secret="s3cret").status_code == 400
+    assert post([1, 2], secret="s3cret").status_code == 400
+    assert webhook_bot.fed == []
+
+
+def test_route_is_inactive_without_a_webhook_bot(monkeypatch):
+    monkeypatch.delitem(ai_chat_system.active_bots, 'telegram', raising=False)
+    assert post({"update_id": 7}, secret="s3cret").status_code == 404